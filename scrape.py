@@ -1,18 +1,28 @@
-import httpx
+import aiohttp
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
-from urllib.parse import urljoin, urlparse, urlunparse, parse_qs, urlencode
+from urllib.parse import urljoin, urlparse, urlsplit, urlunsplit, parse_qsl, urlencode
 import time
+import random
+import hashlib
+import shelve
+import pickle
+import sqlite3
 import logging
+import logging.handlers
+import functools
 import openai
 import os
 import argparse
 import re
 import sys
+import signal
 import asyncio
-import aiofiles
-import urllib.parse
 from asyncio import Semaphore
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing
+import trafilatura
 
 """
 This script is designed to scrape documentation websites and extract the text content of each page.
@@ -26,6 +36,7 @@ Usage:
 Arguments:
     base_url: The base URL of the documentation website to scrape.
     --output: (Optional) The name of the output file. Defaults to "docs_output.txt" if not specified.
+    --resume: (Optional) Resume an interrupted crawl from its saved state, appending to the output file.
 
 The script supports a wide range of documentation website URL patterns and can be customized for different sites.
 """
@@ -41,23 +52,41 @@ load_dotenv()
 # Set up your OpenAI API key
 openai_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-# Replace the existing visited_urls set with a more comprehensive structure
-visited_urls = {}
+# 64-bit hashes of every normalized URL that has been queued for scraping
+visited_urls = set()
+# URLs queued or being scraped, saved with the crawl state so an interrupted run can resume them
+pending_urls = set()
 
 # Set up logging
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+LOG_BUFFER_CAPACITY = 1024  # Records buffered in memory before the log file is written
+
+@functools.lru_cache(maxsize=1)
 def get_log_file_name(base_url):
     """Generate a custom log file name based on the domain of the base URL."""
     domain = urlparse(base_url).netloc
     return f"{domain.replace('.', '_')}_scraping.log"
 
+@functools.lru_cache(maxsize=1)
+def get_state_file_name(base_url):
+    """Generate the crawl state file name based on the domain of the base URL."""
+    domain = urlparse(base_url).netloc
+    return f"{domain.replace('.', '_')}_scraping.visited"
+
 def set_up_logging(base_url):
     """Set up logging with a custom log file name based on the domain of the base URL."""
     log_file = get_log_file_name(base_url)
+    # Buffer file output and write it in batches, flushing straight away on warnings and errors
+    file_handler = logging.FileHandler(log_file, mode="w", delay=True)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    buffered_file_handler = logging.handlers.MemoryHandler(
+        capacity=LOG_BUFFER_CAPACITY, flushLevel=logging.WARNING, target=file_handler
+    )
     logging.basicConfig(
         level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
+        format=LOG_FORMAT,
         handlers=[
-            logging.FileHandler(log_file, mode="w"),
+            buffered_file_handler,
             logging.StreamHandler(sys.stdout)
         ]
     )
@@ -76,69 +105,168 @@ Instructions:
 Strictly return the cleaned text in markdown format, making sure that the end of the text is seperated by a new line or '---' without modifying the actual content or its meaning.
 """
 
+# System prompt for batched requests, which carry several pages separated by markers
+BATCH_MARKER = "<<<DOC {}>>>"
+BATCH_MARKER_PATTERN = re.compile(r"<<<DOC (\d+)>>>")
+BATCH_SYSTEM_PROMPT = SYSTEM_PROMPT + """
+The input contains several independent documents, each starting with a marker line such as <<<DOC 0>>>.
+Clean each document separately and return every document, in the same order, each preceded by its original marker line.
+"""
+
+# Model used to clean the extracted text
+LLM_MODEL = "gpt-4o-mini"
+
+# Cleaned LLM output keyed by a hash of the raw text; replaced by an on-disk shelf in main()
+LLM_CACHE_FILE = ".llm_cache"
+llm_cache = {}
+
+def get_llm_cache_key(raw_text):
+    """Hash the model, prompt and raw text so cached output is invalidated when any of them change."""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (LLM_MODEL, SYSTEM_PROMPT, raw_text):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
 # Constants for retry logic
 INITIAL_DELAY = 3  # seconds
 MAX_RETRIES = 5  # Maximum retry attempts
 MAX_DELAY = 60  # Maximum delay between retries in seconds
-LLM_FAILURE_LIMIT = 18  # Stop after 18 consecutive LLM failures
-LLM_FAILURE_COUNT = 0  # Initialize LLM failure counter
+
+def get_retry_delay(retries, retry_after=None):
+    """Return the back-off delay before retry number `retries`, preferring a server-provided Retry-After."""
+    if retry_after is not None:
+        return min(retry_after, MAX_DELAY)
+    # 3, 6, 12, 24, 48 seconds, with jitter so concurrent retries don't line up, capped at MAX_DELAY
+    return min(MAX_DELAY, INITIAL_DELAY * (2 ** (retries - 1)) * (0.5 + random.random()))
+
+def get_retry_after(error):
+    """Extract the Retry-After header (in seconds) from a failed API call, if present."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
 
 # Headers to mimic a real browser request
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36"
 }
 
-# Replace requests.Session() with httpx.AsyncClient()
+# Connection pool for the shared client: keep connections to the docs host alive across pages
+MAX_CONNECTIONS = 32
+KEEPALIVE_EXPIRY = 75  # seconds
+DNS_CACHE_TTL = 600  # seconds
+REQUEST_TIMEOUT = 30  # seconds, per page fetch
+
+# Replace requests.Session() with aiohttp.ClientSession()
 async def get_client():
-    return httpx.AsyncClient(headers=HEADERS, follow_redirects=True)
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONNECTIONS,
+        limit_per_host=MAX_CONNECTIONS,
+        keepalive_timeout=KEEPALIVE_EXPIRY,
+        ttl_dns_cache=DNS_CACHE_TTL,
+    )
+    return aiohttp.ClientSession(
+        headers=HEADERS,
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+    )
+
+# Links to files that are never scraped
+SKIPPED_FILE_EXTENSIONS = ('.pdf', '.jpg', '.jpeg', '.png', '.gif', '.svg', '.zip', '.css', '.js')
+
+# hrefs that never lead to another page: in-page anchors and non-HTTP schemes
+SKIPPED_HREF_PATTERN = re.compile(r'^\s*(?:#|mailto:|javascript:|tel:|data:)', re.I)
 
-async def is_valid_url(url, base_url):
+@functools.lru_cache(maxsize=1)
+def split_base_url(base_url):
+    """Split the base URL once; it is constant for the whole run."""
+    return urlsplit(base_url)
+
+def is_valid_url(url, base_url):
     """Check if the URL is within the same domain and should be scraped."""
-    parsed_base = urlparse(base_url)
-    parsed_url = urlparse(url)
-    
+    parsed_url = urlsplit(url)
+
     # Check if the domains match
-    if parsed_base.netloc != parsed_url.netloc:
+    if parsed_url.netloc != split_base_url(base_url).netloc:
         return False
     
     # Check if the URL is not a file (e.g., PDF, image)
-    if parsed_url.path.lower().endswith(('.pdf', '.jpg', '.png', '.gif')):
+    if parsed_url.path.lower().endswith(SKIPPED_FILE_EXTENSIONS):
         return False
     
     # Allow URLs with query parameters
     return True
 
-async def normalize_url(url):
-    """Normalize the URL by removing fragments and sorting query parameters."""
-    parsed = urlparse(url)
-    # Remove fragment
-    cleaned = parsed._replace(fragment='')
-    
-    # Sort query parameters
-    query_params = parse_qs(cleaned.query)
-    sorted_query = urlencode(sorted(query_params.items()), doseq=True)
-    cleaned = cleaned._replace(query=sorted_query)
-    
-    return urlunparse(cleaned)
+# Query parameters that only track where a visitor came from and never change the page
+TRACKING_QUERY_PARAMS = {"gclid", "fbclid"}
+DEFAULT_PORTS = {"http": ":80", "https": ":443"}
+
+def is_tracking_param(name):
+    """Check if the query parameter is a tracking parameter (utm_*, gclid, fbclid)."""
+    return name.startswith("utm_") or name in TRACKING_QUERY_PARAMS
+
+def normalize_url(url):
+    """Normalize the URL: lowercase the scheme and host, drop default ports, fragments and tracking parameters, sort the query."""
+    parsed = urlsplit(url)
+    scheme = parsed.scheme.lower()
+    netloc = parsed.netloc.lower().removesuffix(DEFAULT_PORTS.get(scheme, ""))
+    path = parsed.path or "/"
+
+    # Sort query parameters by name, keeping the order of repeated values
+    query_params = [
+        (name, value)
+        for name, value in parse_qsl(parsed.query, keep_blank_values=True)
+        if not is_tracking_param(name)
+    ]
+    query = urlencode(sorted(query_params, key=lambda param: param[0]))
+
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+def canonical_url(normalized_url):
+    """Return the key a normalized URL is deduplicated on, so that /page and /page/ count as the same page."""
+    parsed = urlsplit(normalized_url)
+    return urlunsplit(parsed._replace(path=parsed.path.rstrip("/") or "/"))
+
+# Cap the number of page fetches in flight so wide pages don't open a request per link at once
+MAX_CONCURRENT_FETCHES = 8
+fetch_semaphore = Semaphore(MAX_CONCURRENT_FETCHES)
+
+def resolve_link(href, current_url, base_url):
+    """Resolve a link against the current page and return its normalized URL, or None if it should not be scraped."""
+    if SKIPPED_HREF_PATTERN.match(href):
+        return None
+    normalized_url = normalize_url(urljoin(current_url, href))
+    if is_valid_url(normalized_url, base_url):
+        return normalized_url
+    return None
 
-async def fetch_url_content(url, client):
-    """Fetch the content from the URL with retry logic, skip on 403 or 404 errors."""
+async def fetch_url_content(url, client, headers=None):
+    """Fetch the content from the URL with retry logic, skip on 403 or 404 errors.
+
+    Returns a (status, content, response headers) tuple, or None if the page was skipped.
+    """
     retries = 0
     while retries < MAX_RETRIES:
         try:
-            response = await client.get(url)
-            if response.status_code in [404, 403]:
-                logging.warning(f"{response.status_code} Error: Skipping {url}")
-                return None
-            response.raise_for_status()
-            return response.content
-        except httpx.RequestError as e:
+            async with fetch_semaphore, fetch_rate_limiter, client.get(url, headers=headers) as response:
+                if response.status in [404, 403]:
+                    logging.warning("%s Error: Skipping %s", response.status, url)
+                    return None
+                response.raise_for_status()
+                return response.status, await response.read(), response.headers
+        except aiohttp.ClientResponseError:
+            raise  # HTTP error statuses are not retried
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             retries += 1
-            logging.warning(f"Attempt {retries} failed for {url}: {e}")
-            delay = min(INITIAL_DELAY * (2 ** retries), MAX_DELAY)
-            logging.info(f"Waiting for {delay} seconds before retrying {url}...")
+            logging.warning("Attempt %d failed for %s: %s", retries, url, e)
+            delay = get_retry_delay(retries)
+            logging.info("Waiting for %.1f seconds before retrying %s...", delay, url)
             await asyncio.sleep(delay)
-    logging.error(f"Max retries reached for {url}. Skipping.")
+    logging.error("Max retries reached for %s. Skipping.", url)
     return None
 
 # Add these constants at the top of the file
@@ -148,22 +276,27 @@ REQUESTS_PER_MINUTE = 25
 # Create a semaphore to limit concurrent requests
 api_semaphore = Semaphore(MAX_CONCURRENT_REQUESTS)
 
-# Create a rate limiter
+# Create a rate limiter (token bucket: bursts up to max_calls, refilled at max_calls per period)
 class RateLimiter:
     def __init__(self, max_calls, period):
         self.max_calls = max_calls
         self.period = period
-        self.calls = []
+        self.rate = max_calls / period  # tokens per second
+        self.tokens = float(max_calls)
+        self.last = time.monotonic()
         self.lock = asyncio.Lock()
 
     async def __aenter__(self):
         async with self.lock:
-            now = time.time()
-            self.calls = [call for call in self.calls if call > now - self.period]
-            if len(self.calls) >= self.max_calls:
-                sleep_time = self.calls[0] - (now - self.period)
-                await asyncio.sleep(sleep_time)
-            self.calls.append(time.time())
+            now = time.monotonic()
+            self.tokens = min(self.max_calls, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.tokens = 0
+                self.last = time.monotonic()
+            else:
+                self.tokens -= 1
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         pass
@@ -171,179 +304,569 @@ class RateLimiter:
 # Create a rate limiter instance
 rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, 60)
 
+# Opened on rate-limit (429) and server (5xx) errors so all LLM callers wait out the cool-down together
+class CircuitBreaker:
+    def __init__(self):
+        self.closed = asyncio.Event()
+        self.closed.set()
+        self.open_until = 0.0
+        self.reset_handle = None
+
+    async def wait(self):
+        """Wait until the breaker is closed."""
+        await self.closed.wait()
+
+    def trip(self, cooldown):
+        """Open the breaker for `cooldown` seconds, extending it if it is already open."""
+        loop = asyncio.get_running_loop()
+        open_until = loop.time() + cooldown
+        if open_until <= self.open_until:
+            return
+        if self.closed.is_set():
+            logging.warning("LLM API overloaded. Pausing all LLM calls for %.1f seconds.", cooldown)
+        self.open_until = open_until
+        self.closed.clear()
+        if self.reset_handle is not None:
+            self.reset_handle.cancel()
+        self.reset_handle = loop.call_at(open_until, self.closed.set)
+
+# Create a circuit breaker instance
+llm_circuit_breaker = CircuitBreaker()
+
+# Pace page fetches to the docs host instead of sleeping after every page
+FETCH_REQUESTS_PER_SECOND = 10
+fetch_rate_limiter = RateLimiter(FETCH_REQUESTS_PER_SECOND, 1)
+
+# Input budget per LLM request; larger pages are split and cleaned in parallel
+MAX_INPUT_TOKENS = 3000
+CHARS_PER_TOKEN = 4  # Rough average for English text with the gpt-4o tokenizer
+
+def estimate_tokens(text):
+    """Estimate the number of tokens in the text from its length."""
+    return len(text) // CHARS_PER_TOKEN
+
+def split_text(text, max_tokens):
+    """Split the text at line boundaries into pieces that each fit within max_tokens."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    chunks = []
+    current = []
+    current_len = 0
+    for line in text.splitlines():
+        if current and current_len + len(line) + 1 > max_chars:
+            chunks.append("\n".join(current))
+            current = []
+            current_len = 0
+        # Lines longer than a whole chunk are split hard
+        while len(line) > max_chars:
+            chunks.append(line[:max_chars])
+            line = line[max_chars:]
+        current.append(line)
+        current_len += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
 async def clean_text_with_llm(raw_text):
-    """Send the raw text to the LLM for cleaning with retry logic, stop after 18 consecutive failures."""
-    global LLM_FAILURE_COUNT
+    """Clean the raw text with the LLM, splitting pages over MAX_INPUT_TOKENS into concurrent requests."""
+    if estimate_tokens(raw_text) <= MAX_INPUT_TOKENS:
+        return await clean_chunk_with_llm(raw_text)
+
+    chunks = split_text(raw_text, MAX_INPUT_TOKENS)
+    cleaned_chunks = await asyncio.gather(*(clean_chunk_with_llm(chunk) for chunk in chunks))
+    return "\n\n".join(chunk for chunk in cleaned_chunks if chunk)
+
+async def clean_chunk_with_llm(raw_text):
+    """Clean a single chunk of text, using the cache when possible and batching misses with other chunks."""
+    cache_key = get_llm_cache_key(raw_text)
+    if cache_key in llm_cache:
+        return llm_cache[cache_key]
+
+    cleaned_text = await llm_batcher.submit(raw_text)
+    if cleaned_text:
+        llm_cache[cache_key] = cleaned_text
+    return cleaned_text
+
+async def request_llm_cleaning(system_prompt, raw_text):
+    """Send the raw text to the LLM for cleaning with retry logic, backing off globally on rate-limit and server errors."""
     retries = 0
     while retries < MAX_RETRIES:
+        await llm_circuit_breaker.wait()
         try:
             async with api_semaphore, rate_limiter:
                 messages = [
-                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "system", "content": system_prompt},
                     {"role": "user", "content": raw_text},
                 ]
                 response = await openai_client.chat.completions.create(
-                    model="gpt-4o-mini",
+                    model=LLM_MODEL,
                     temperature=0,  # little to no randomness
                     messages=messages,
                 )
                 if response.choices:
-                    LLM_FAILURE_COUNT = 0  # Reset LLM failure count on success
-                    return response.choices[0].message.content
+                    return response.choices[0].message.content or ""
+        except (openai.RateLimitError, openai.InternalServerError) as e:
+            # The API is overloaded: hold back every caller, not just this one
+            retries += 1
+            logging.warning("LLM cleaning attempt %d failed: %s", retries, e)
+            llm_circuit_breaker.trip(get_retry_delay(retries, get_retry_after(e)))
         except Exception as e:
             retries += 1
-            LLM_FAILURE_COUNT += 1
-            logging.warning(f"LLM cleaning attempt {retries} failed: {e}")
-            if retries % 3 == 0:
-                logging.info("Waiting for 10 seconds before retrying LLM cleaning...")
-                await asyncio.sleep(10)
-            else:
-                await asyncio.sleep(INITIAL_DELAY)
-
-            if LLM_FAILURE_COUNT >= LLM_FAILURE_LIMIT:
-                logging.critical("18 consecutive LLM failures. Stopping the script.")
-                raise Exception(
-                    "Too many consecutive LLM failures. Stopping the script."
-                )
+            logging.warning("LLM cleaning attempt %d failed: %s", retries, e)
+            delay = get_retry_delay(retries, get_retry_after(e))
+            logging.info("Waiting for %.1f seconds before retrying LLM cleaning...", delay)
+            await asyncio.sleep(delay)
     logging.error("Max retries reached for LLM cleaning. Skipping.")
     return ""
 
-async def extract_text_from_url(url, client):
-    """Fetch and parse the webpage content, then clean it using LLM."""
-    content = await fetch_url_content(url, client)
-    if content is None:
-        return "", []
+def split_batch_response(response, count):
+    """Split a batched LLM response on its document markers, returning None unless every document is present."""
+    pieces = BATCH_MARKER_PATTERN.split(response)
+    # pieces alternates [preamble, index, text, index, text, ...]
+    documents = {int(index): text.strip() for index, text in zip(pieces[1::2], pieces[2::2])}
+    if sorted(documents) != list(range(count)):
+        return None
+    return [documents[i] for i in range(count)]
+
+async def clean_batch_with_llm(texts):
+    """Clean several texts with one LLM request, falling back to one request per text if the reply can't be split."""
+    if len(texts) == 1:
+        return [await request_llm_cleaning(SYSTEM_PROMPT, texts[0])]
+
+    batch_text = "".join(f"{BATCH_MARKER.format(i)}\n{text}\n" for i, text in enumerate(texts))
+    response = await request_llm_cleaning(BATCH_SYSTEM_PROMPT, batch_text)
+    if not response:
+        return [""] * len(texts)
+
+    cleaned_texts = split_batch_response(response, len(texts))
+    if cleaned_texts is None:
+        logging.warning("Could not split batched LLM response into %d documents. Cleaning them one by one.", len(texts))
+        return await asyncio.gather(*(request_llm_cleaning(SYSTEM_PROMPT, text) for text in texts))
+    return cleaned_texts
+
+# Coalesce small pages into a single LLM request to cut round trips under the rate limit
+LLM_BATCH_SIZE = 8  # Maximum texts per request
+LLM_BATCH_WAIT = 0.5  # seconds to wait for more texts before sending a partial batch
+
+class LLMBatcher:
+    def __init__(self, batch_size, max_tokens, max_wait):
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.collector = None
+        self.batches = set()  # Keep references to in-flight batch tasks
+
+    async def submit(self, raw_text):
+        """Queue the text for the next batch and wait for its cleaned result."""
+        if self.collector is None:
+            self.collector = asyncio.create_task(self.collect())
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((raw_text, future))
+        return await future
+
+    async def collect(self):
+        """Group queued texts into batches bounded by count, token budget and wait time, and dispatch them."""
+        loop = asyncio.get_running_loop()
+        carried = None
+        while True:
+            item = carried or await self.queue.get()
+            carried = None
+            batch = [item]
+            tokens = estimate_tokens(item[0])
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.batch_size and tokens < self.max_tokens:
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                item_tokens = estimate_tokens(item[0])
+                if tokens + item_tokens > self.max_tokens:
+                    carried = item  # Starts the next batch
+                    break
+                batch.append(item)
+                tokens += item_tokens
+
+            task = asyncio.create_task(self.run_batch(batch))
+            self.batches.add(task)
+            task.add_done_callback(self.batches.discard)
+
+    async def run_batch(self, batch):
+        """Clean a batch and hand each caller its result."""
+        try:
+            cleaned_texts = await clean_batch_with_llm([raw_text for raw_text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), cleaned_text in zip(batch, cleaned_texts):
+                if not future.done():
+                    future.set_result(cleaned_text)
+
+# Process pool for HTML parsing; created in main(), None runs parsing in the default thread pool
+parse_pool = None
+
+# Validators and cleaned text of previously scraped pages, so unchanged pages can be skipped with a conditional GET
+PAGE_CACHE_FILE = ".page_cache.sqlite3"
+
+class CachedPage:
+    def __init__(self, etag, last_modified, cleaned_text, links):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.cleaned_text = cleaned_text
+        self.links = links
+
+    def conditional_headers(self):
+        """Build the If-None-Match / If-Modified-Since headers for revalidating this page."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+class PageCache:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        # WAL with synchronous=NORMAL avoids an fsync on every page's commit
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS pages "
+            "(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, cleaned_text TEXT, links TEXT)"
+        )
 
-    soup = BeautifulSoup(content, "html.parser")
+    def get(self, url):
+        """Return the cached page for the URL, or None if it has never been stored."""
+        row = self.db.execute(
+            "SELECT etag, last_modified, cleaned_text, links FROM pages WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, cleaned_text, links = row
+        return CachedPage(etag, last_modified, cleaned_text, set(links.split("\n")) if links else set())
+
+    def put(self, url, etag, last_modified, cleaned_text, links):
+        """Store the page's validators, cleaned text and links; pages without validators are not cached."""
+        if not etag and not last_modified:
+            return
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                (url, etag, last_modified, cleaned_text, "\n".join(links)),
+            )
+
+    def close(self):
+        self.db.close()
+
+# Opened in main()
+page_cache = None
+
+# Create an LLM batcher instance
+llm_batcher = LLMBatcher(LLM_BATCH_SIZE, MAX_INPUT_TOKENS, LLM_BATCH_WAIT)
+
+def init_parse_worker():
+    """Ignore Ctrl+C in parse processes; the main process handles it and shuts the pool down."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Heuristic extractions shorter than this are treated as failures and cleaned with the LLM instead
+MIN_EXTRACTED_LENGTH = 200
+
+def extract_main_content(content):
+    """Extract the page's main content as markdown with trafilatura, or return None if it is missing or too short."""
+    extracted = trafilatura.extract(
+        content,
+        output_format="markdown",
+        favor_precision=True,
+        include_tables=True,
+        include_links=False,
+    )
+    if extracted is None or len(extracted) < MIN_EXTRACTED_LENGTH:
+        return None
+    return extracted
+
+# Selectors for the main content region of common docs themes, most specific first
+CONTENT_SELECTORS = ('.md-content', '[role=main]', 'main', 'article', '.document')
+# Share of a main region's text its single article must hold for the region to be narrowed to it
+MIN_ARTICLE_SHARE = 0.8
+
+def find_single_article(region):
+    """Return the region's <article> if it has exactly one, else None; several articles are all content."""
+    articles = region.select('article')
+    return articles[0] if len(articles) == 1 else None
+
+def find_content_region(soup):
+    """Return the page's main content element, or the whole body if no known content region is found."""
+    for selector in CONTENT_SELECTORS:
+        if selector == 'article':
+            region = find_single_article(soup)
+        else:
+            region = soup.select_one(selector)
+        if region is None:
+            continue
+        # Narrow a main region to its article only when that is its sole article and holds most of its text,
+        # so intros, card grids and other text around the article are kept
+        if selector in ('[role=main]', 'main'):
+            article = find_single_article(region)
+            if article is not None:
+                article_length = len(article.get_text(strip=True))
+                if article_length >= MIN_ARTICLE_SHARE * len(region.get_text(strip=True)):
+                    return article
+        return region
+    return soup.body or soup
+
+# Known content and navigation selectors for the sites this tool is used on, keyed by netloc.
+# Pages on these sites take their text from the content region and their links from the content
+# and sidebar navigation only, skipping headers, footers and other site chrome.
+MKDOCS_MATERIAL_PROFILE = {'content': '.md-content', 'nav': '.md-nav--primary'}
+SPHINX_RTD_PROFILE = {'content': '[role=main]', 'nav': '.wy-menu-vertical'}
+DOMAIN_PROFILES = {
+    'docs.pydantic.dev': MKDOCS_MATERIAL_PROFILE,
+    'ai.pydantic.dev': MKDOCS_MATERIAL_PROFILE,
+    'docs.astral.sh': MKDOCS_MATERIAL_PROFILE,
+    'langchain-ai.github.io': MKDOCS_MATERIAL_PROFILE,
+    'qdrant.github.io': MKDOCS_MATERIAL_PROFILE,
+    'python-client.qdrant.tech': SPHINX_RTD_PROFILE,
+}
+# Unknown sites use the generic content selectors and every link on the page
+DEFAULT_PROFILE = {'content': None, 'nav': None}
+
+# Selected for the base URL in main()
+domain_profile = DEFAULT_PROFILE
+
+def get_domain_profile(base_url):
+    """Return the scraping profile for the base URL's site, or the default profile for unknown sites."""
+    return DOMAIN_PROFILES.get(split_base_url(base_url).netloc, DEFAULT_PROFILE)
+
+def find_link_regions(soup, content_region, profile):
+    """Return the elements to collect links from: the content and nav regions for profiled sites, else the whole page."""
+    if profile['nav'] is None:
+        return [soup]
+    nav_regions = soup.select(profile['nav'])
+    if not nav_regions:
+        # The site's layout no longer matches its profile; scan the whole page rather than miss links
+        return [soup]
+    return [content_region, *nav_regions]
+
+def parse_page(content, url, base_url, profile=DEFAULT_PROFILE):
+    """Parse the page and return its raw text, its trafilatura extraction (if any) and the valid links found on it.
+
+    Runs in the parse process pool.
+    """
+    extracted_text = extract_main_content(content)
+    soup = BeautifulSoup(content, "lxml")
 
     # Remove script and style elements
     for script in soup(["script", "style"]):
         script.decompose()
 
-    # Extract raw text content
-    raw_text_content = soup.get_text()
-    cleaned_text = "\n".join(
-        [line.strip() for line in raw_text_content.splitlines() if line.strip()]
+    # Extract raw text content from the main content region, stripping each line once and dropping blank ones
+    content_region = None
+    if profile['content'] is not None:
+        content_region = soup.select_one(profile['content'])
+    if content_region is None:
+        content_region = find_content_region(soup)
+    raw_text = "\n".join(filter(None, map(str.strip, content_region.get_text().splitlines())))
+
+    # Extract all valid links within the link regions in a single pass. This covers pagination, next/previous,
+    # sidebar and query-string navigation links, which are all <a href> elements too.
+    page_links = set()
+    for region in find_link_regions(soup, content_region, profile):
+        for link in region.find_all("a", href=True):
+            normalized_url = resolve_link(link["href"], url, base_url)
+            if normalized_url:
+                page_links.add(normalized_url)
+
+    return raw_text, extracted_text, page_links
+
+async def extract_text_from_url(url, client):
+    """Fetch and parse the webpage content, then clean it using LLM."""
+    # Revalidate pages cleaned on an earlier run instead of downloading and cleaning them again
+    cached_page = page_cache.get(url) if page_cache is not None else None
+    result = await fetch_url_content(url, client, cached_page.conditional_headers() if cached_page else None)
+    if result is None:
+        return "", set()
+    status, content, headers = result
+    del result  # Drop the tuple's reference so deleting content below frees the HTML
+    if status == 304 and cached_page:
+        logging.info("%s not modified since the last run. Reusing its cleaned text.", url)
+        return cached_page.cleaned_text, cached_page.links
+
+    # Parse in the process pool so parsing runs on all cores instead of blocking the event loop
+    loop = asyncio.get_running_loop()
+    raw_text, extracted_text, page_links = await loop.run_in_executor(
+        parse_pool, parse_page, content, url, base_url, domain_profile
     )
+    del content  # Let the raw HTML be freed while waiting on the LLM
 
-    # Clean the text using the LLM
-    cleaned_text = await clean_text_with_llm(cleaned_text)
-
-    # Extract and return all valid links within the page
-    links = soup.find_all("a", href=True)
-    page_links = []
-    for link in links:
-        full_url = urljoin(url, link["href"])
-        normalized_url = await normalize_url(full_url)
-        if await is_valid_url(normalized_url, base_url):
-            page_links.append(normalized_url)
-    
-    # Look for pagination links
-    pagination_links = await find_pagination_links(soup, url)
-    page_links.extend(pagination_links)
+    # Use the heuristic extraction when it found the content, otherwise clean the text using the LLM
+    if extracted_text:
+        cleaned_text = extracted_text
+    else:
+        cleaned_text = await clean_text_with_llm(raw_text)
 
-    return cleaned_text, list(set(page_links))  # Remove duplicates
+    if page_cache is not None and cleaned_text:
+        page_cache.put(url, headers.get("ETag"), headers.get("Last-Modified"), cleaned_text, page_links)
 
-async def find_pagination_links(soup, current_url):
-    """Find pagination links in the page."""
-    pagination_links = set()
-    base_url = urlparse(current_url).scheme + "://" + urlparse(current_url).netloc
-    
-    # Look for common pagination patterns
-    pagination_elements = soup.find_all(class_=re.compile(r'pagination|pager|nav'))
-    for element in pagination_elements:
-        links = element.find_all('a', href=True)
-        for link in links:
-            full_url = urljoin(current_url, link["href"])
-            normalized_url = await normalize_url(full_url)
-            if await is_valid_url(normalized_url, base_url):
-                pagination_links.add(normalized_url)
-    
-    # Look for "Next" or "Previous" links
-    next_links = soup.find_all('a', string=re.compile(r'next|forward', re.I), href=True)
-    prev_links = soup.find_all('a', string=re.compile(r'previous|back', re.I), href=True)
-    for link in next_links + prev_links:
-        full_url = urljoin(current_url, link["href"])
-        normalized_url = await normalize_url(full_url)
-        if await is_valid_url(normalized_url, base_url):
-            pagination_links.add(normalized_url)
-    
-    # Look for sidebar navigation links
-    sidebar_elements = soup.find_all(class_=re.compile(r'sidebar|menu|toc'))
-    for element in sidebar_elements:
-        links = element.find_all('a', href=True)
-        for link in links:
-            full_url = urljoin(current_url, link["href"])
-            normalized_url = await normalize_url(full_url)
-            if await is_valid_url(normalized_url, base_url):
-                pagination_links.add(normalized_url)
-    
-    # Look for query parameter-based navigation
-    links_with_params = soup.find_all('a', href=re.compile(r'\?'))
-    for link in links_with_params:
-        full_url = urljoin(current_url, link["href"])
-        normalized_url = await normalize_url(full_url)
-        if await is_valid_url(normalized_url, base_url):
-            pagination_links.add(normalized_url)
-    
-    return list(pagination_links)
+    return cleaned_text, page_links
 
-async def is_subdirectory(url, base_url):
+def is_subdirectory(url, base_url):
     """Check if the given URL is a subdirectory of the base URL."""
-    parsed_url = urllib.parse.urlparse(url)
-    parsed_base = urllib.parse.urlparse(base_url)
-    
+    parsed_url = urlsplit(url)
+    parsed_base = split_base_url(base_url)
+
     return (parsed_url.scheme == parsed_base.scheme and
             parsed_url.netloc == parsed_base.netloc and
             parsed_url.path.startswith(parsed_base.path))
 
-async def traverse_and_extract(url, output_file, client, base_url):
-    """Recursively traverse through each URL and extract content."""
-    normalized_url = await normalize_url(url)
-    
-    # Check if the URL has been visited or is not a subdirectory of the base URL
-    if normalized_url in visited_urls or not await is_subdirectory(normalized_url, base_url):
-        return
-
-    visited_urls[normalized_url] = True
-    logging.info(f"Scraping {normalized_url}")
+async def process_url(normalized_url, output_fh, client):
+    """Scrape a single URL, write its cleaned text to the output file and return the links found on it."""
+    logging.info("Scraping %s", normalized_url)
 
     try:
         cleaned_text, links = await extract_text_from_url(normalized_url, client)
         if cleaned_text == "":
-            logging.warning(f"No content extracted from {normalized_url}. Skipping.")
-            return
+            logging.warning("No content extracted from %s. Skipping.", normalized_url)
+            return set()
+    except BrokenProcessPool:
+        # Every later page would fail too; stop the crawl and leave the page pending for --resume
+        raise
     except Exception as e:
-        logging.error(f"Error during scraping {normalized_url}: {e}")
-        return
-
-    # Write the cleaned text to the file
-    async with aiofiles.open(output_file, "a", encoding="utf-8") as file:
-        await file.write(f"URL: {normalized_url}\n\n")
-        await file.write(cleaned_text + "\n\n")
-        await file.write("=" * 80 + "\n\n")  # Separator
-
-    # Pause briefly between requests to avoid overloading the server
-    await asyncio.sleep(2)  # Increased delay to be more considerate
-
-    # Recursively traverse through each link
-    tasks = []
-    for link in links:
-        if link not in visited_urls and await is_subdirectory(link, base_url):
-            tasks.append(traverse_and_extract(link, output_file, client, base_url))
-    await asyncio.gather(*tasks)
+        logging.error("Error during scraping %s: %s", normalized_url, e)
+        return set()
+
+    # Write the cleaned text to the file as a single block so concurrent pages don't interleave.
+    # The file is buffered, so this is an in-memory copy except when the buffer fills and is flushed.
+    separator = "=" * 80
+    output_fh.write(f"URL: {normalized_url}\n\n{cleaned_text}\n\n{separator}\n\n")
+    return links
+
+# Crawl state (visited URL hashes and pending URLs) is checkpointed this often so --resume can pick it up
+CHECKPOINT_INTERVAL = 60  # seconds
+
+def get_url_hash(url):
+    """Hash a canonical URL to a 64-bit integer for compact visited-URL tracking."""
+    return int.from_bytes(hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest(), "big")
+
+def load_crawl_state(state_file):
+    """Load the base URL, visited URL hashes and pending URLs saved by a previous run."""
+    with open(state_file, "rb") as file:
+        state = pickle.load(file)
+    return state.get("base_url"), state["visited"], state["pending"]
+
+def save_crawl_state(state_file, base_url, visited, pending):
+    """Write the base URL, visited URL hashes and pending URLs to the state file, replacing it atomically."""
+    tmp_file = f"{state_file}.tmp"
+    with open(tmp_file, "wb") as file:
+        pickle.dump({"base_url": base_url, "visited": visited, "pending": pending}, file)
+    os.replace(tmp_file, state_file)
+
+async def checkpoint_crawl_state(state_file, output_fh, base_url):
+    """Periodically save the crawl state until cancelled."""
+    while True:
+        await asyncio.sleep(CHECKPOINT_INTERVAL)
+        # Flush on the loop thread (the file object isn't thread-safe) together with the snapshot,
+        # so the saved state never marks pages done that are still only in the buffer
+        visited, pending = set(visited_urls), list(pending_urls)
+        output_fh.flush()
+        await asyncio.to_thread(save_crawl_state, state_file, base_url, visited, pending)
+
+def try_claim(url):
+    """Mark the URL visited and return True, or return False if it was already claimed.
+
+    Must not await between the check and the add, so concurrent workers can't both claim the same URL.
+    """
+    url_hash = get_url_hash(canonical_url(url))
+    if url_hash in visited_urls:
+        return False
+    visited_urls.add(url_hash)
+    return True
 
-async def main(base_url, output_file):
-    async with await get_client() as client:
-        await traverse_and_extract(base_url, output_file, client, base_url)
+async def crawl_worker(queue, output_fh, client, base_url):
+    """Take URLs off the queue, scrape them and queue any new links found, until cancelled."""
+    while True:
+        normalized_url = await queue.get()
+        try:
+            links = await process_url(normalized_url, output_fh, client)
+            # Mark each link visited as it is queued so it is only scraped once
+            for link in links:
+                if is_subdirectory(link, base_url) and try_claim(link):
+                    pending_urls.add(link)
+                    queue.put_nowait(link)
+            pending_urls.discard(normalized_url)
+        finally:
+            queue.task_done()
+
+async def traverse_and_extract(output_fh, client, base_url, state_file, resume=False):
+    """Traverse every URL under the base URL with a pool of workers and extract its content."""
+    queue = asyncio.Queue()
+    if resume and os.path.exists(state_file):
+        saved_base_url, visited, pending = await asyncio.to_thread(load_crawl_state, state_file)
+        # The state file is per domain, so it may belong to a crawl of another path on the same site
+        if saved_base_url != base_url:
+            raise ValueError(
+                f"{state_file} holds the crawl state of {saved_base_url or 'an unknown base URL'}, not {base_url}. "
+                "Run without --resume to start a new crawl."
+            )
+        visited_urls.update(visited)
+        pending_urls.update(url for url in pending if is_subdirectory(url, base_url))
+        logging.info("Resuming crawl from %s: %d URLs visited, %d pending.", state_file, len(visited), len(pending_urls))
+    else:
+        start_url = normalize_url(base_url)
+        try_claim(start_url)
+        pending_urls.add(start_url)
+    for url in pending_urls:
+        queue.put_nowait(url)
+
+    workers = [
+        asyncio.create_task(crawl_worker(queue, output_fh, client, base_url))
+        for _ in range(MAX_CONCURRENT_REQUESTS)
+    ]
+    join_task = asyncio.create_task(queue.join())
+    checkpoint_task = asyncio.create_task(checkpoint_crawl_state(state_file, output_fh, base_url))
+    try:
+        # Stop when the queue is drained, or as soon as a worker fails unexpectedly
+        await asyncio.wait([join_task, *workers], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        checkpoint_task.cancel()
+        join_task.cancel()
+        for worker in workers:
+            worker.cancel()
+        results = await asyncio.gather(checkpoint_task, join_task, *workers, return_exceptions=True)
+        # Whatever is still pending (queued or interrupted mid-scrape) is picked up by --resume
+        save_crawl_state(state_file, base_url, visited_urls, list(pending_urls))
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+# Output is written through one buffered file handle for the whole run
+OUTPUT_BUFFER_SIZE = 1 << 20  # 1 MiB
+
+async def main(base_url, output_file, resume=False):
+    global llm_cache, parse_pool, page_cache, domain_profile
+    state_file = get_state_file_name(base_url)
+    domain_profile = get_domain_profile(base_url)
+    with (
+        shelve.open(LLM_CACHE_FILE) as llm_cache,
+        closing(PageCache(PAGE_CACHE_FILE)) as page_cache,
+        ProcessPoolExecutor(initializer=init_parse_worker) as parse_pool,
+    ):
+        async with await get_client() as client:
+            with open(output_file, "a", encoding="utf-8", buffering=OUTPUT_BUFFER_SIZE) as output_fh:
+                await traverse_and_extract(output_fh, client, base_url, state_file, resume)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Scrape documentation websites")
     parser.add_argument("base_url", help="Base URL of the documentation website")
     parser.add_argument("--output", default="docs_output.txt", help="Output file name")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted crawl, skipping URLs already visited by the previous run",
+    )
     args = parser.parse_args()
 
-    base_url = args.base_url
+    base_url = normalize_url(args.base_url)
     start_url = base_url
     output_file = args.output
 
@@ -357,14 +880,14 @@ if __name__ == "__main__":
     print("Press Ctrl+C to stop the scraping process.")
 
     try:
-        asyncio.run(main(start_url, output_file))
+        asyncio.run(main(start_url, output_file, args.resume))
         logging.info(
-            f"Text extraction and cleaning complete. Check the {output_file} file."
+            "Text extraction and cleaning complete. Check the %s file.", output_file
         )
     except KeyboardInterrupt:
         print("\nScraping interrupted by user.")
     except Exception as e:
-        logging.critical(f"Critical error: {e}")
+        logging.critical("Critical error: %s", e)
         print("An error occurred. Check the log file for details.")
 
     print(f"Scraping finished. Log file saved as: {log_file}")